@@ -1,158 +1,310 @@
-from dotenv import load_dotenv
 import os
-from crewai import Agent, Task, Crew, LLM, Process
+import re
+import asyncio
+from typing import Callable, List, NamedTuple, Optional
+from crewai import Agent, Task, Crew, Process, TaskOutput
 from crewai_tools import FileReadTool
+from llm_cache import CachedLLM
+from config import GEMINI_API_KEY_1, GEMINI_API_KEY_2
 
-# Load environment variables from .env file
-load_dotenv()
+# -------------------- Shared prompt prefix --------------------
+# Every agent prompt starts with the same text (pipeline header, stories and class information)
+# and only then the agent's own role and task, so Gemini can reuse the cached prefix across calls.
 
-# Tool Initialization
-file_read_tool = FileReadTool()
+STORIES_FILE = "project_output/stories.txt"
+CODE_FILE = "project_output/code.txt"
 
-# LLMs with keys from environment variables
-llm = LLM(
-    model='gemini/gemini-2.0-flash',
-    api_key=os.getenv("GEMINI_API_KEY_1")
-)
-llm_new = LLM(
-    model='gemini/gemini-2.0-flash',
-    api_key=os.getenv("GEMINI_API_KEY_2")
-)
-# -------------------- Agents --------------------
-
-TL_agent = Agent(
-    role="Team Lead",
-    goal="Analyze stories and break them into clear development and testing tasks.",
-    backstory="You're a tech-savvy Team Lead who understands both development and testing in Spring Boot applications. "
-              "Your job is to read user stories from a file and assign specific tasks to the developer and tester based on the story requirements.",
-    llm=llm_new,
-    tools=[file_read_tool],
-    allow_delegation=True,
-    verbose=True
+PIPELINE_HEADER = (
+    "You are part of a 5-agent pipeline (Team Lead, Backend Developer, Code Reviewer, QA Engineer and "
+    "Test Case Reviewer) that implements user stories for a Java Spring Boot project.\n"
 )
 
-developer_agent = Agent(
-    role="Backend Developer",
-    goal="Generate Java Spring Boot code that meets the assigned user story requirements and code. Do not write test code.",
-    backstory="You're a backend developer specialized in Java, Spring Boot, and JPA. "
-              "Based on tasks assigned by the Team Lead and class information from a file, your responsibility is to implement only the backend logic.",
-    llm=llm,
-    allow_delegation=False,
-    verbose=True
-)
+def build_shared_prefix() -> str:
+    sections = [PIPELINE_HEADER]
+    for label, path in (("User stories", STORIES_FILE), ("Class information", CODE_FILE)):
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                sections.append(f"\n=== {label} ({path}) ===\n{f.read()}\n")
+    sections.append("\n=== Your role ===\n")
+    return "".join(sections)
 
-developer_approver_agent = Agent(
-    role="Code Reviewer",
-    goal="Evaluate and approve Java code submitted by the developer, ensuring it fulfills the user story and follows best practices.",
-    backstory="You're a senior software architect who reviews Java Spring Boot code. "
-              "You ensure correctness, alignment with the story, and coding standards before approval.",
-    llm=llm_new,
-    allow_delegation=False,
-    verbose=True
-)
+# -------------------- Template shortcuts --------------------
+# Steps that are plain text handling are done in Python instead of with an LLM call.
 
-tester_agent = Agent(
-    role="QA Engineer",
-    goal="Generate JUnit test cases based on the functionality implemented by the developer and tasks assigned by the Team Lead.",
-    backstory="You're a software tester with deep understanding of backend systems. "
-              "Using class data and the developer's code, you create high-quality JUnit test cases.",
-    llm=llm,
-    allow_delegation=False,
-    verbose=True
-)
+DEVELOPER_CODE_FILE = "project_output/developer_code.txt"
+TESTER_CODE_FILE = "project_output/tester_code.txt"
 
-tester_approver_agent = Agent(
-    role="Test Case Reviewer",
-    goal="Review the JUnit test cases to ensure they comprehensively validate the assigned functionality and follow best practices.",
-    backstory="You're a seasoned QA lead who checks if JUnit test cases are sufficient, accurate, and aligned with the user story and implementation.",
-    llm=llm_new,
-    allow_delegation=False,
-    verbose=True
-)
+STORY_HEADING = re.compile(r"^## Story \d+", re.MULTILINE)
+# Lines that group stories into other sections, e.g. "# Developer Stories" or "**Tester stories:**"
+SECTION_LINE = re.compile(r"^(#{1,2} .*|\W*(developer|tester)s?( user)?( stories| tasks)?\W*)$", re.IGNORECASE)
 
-# -------------------- Tasks --------------------
-
-TL_task = Task(
-    description="Read stories from the input file and assign tasks separately for development and testing. "
-                "Ensure each task clearly refers to a specific story and includes enough detail for execution.",
-    agent=TL_agent,
-    tools=[file_read_tool],
-    expected_output="Tasks assigned to developer and tester, indicating which story each task belongs to.",
-    input={
-        "user_stories": "{{myenv/output/stories.txt}}"
-    }
-)
+def split_stories(stories_text: str) -> List[str]:
+    """
+    Splits a stories file on its '## Story N' headings. Returns an empty list unless the file
+    is made only of such sections, so any other layout is left to the Team Lead LLM.
+    """
+    stories_text = stories_text.strip()
+    starts = [match.start() for match in STORY_HEADING.finditer(stories_text)]
+    if not starts or starts[0] != 0:
+        return []
+    for line in stories_text.splitlines():
+        if SECTION_LINE.match(line.strip()) and not STORY_HEADING.match(line):
+            return []
+    return [stories_text[start:end].strip() for start, end in zip(starts, starts[1:] + [len(stories_text)])]
 
-developer_task = Task(
-    description="Implement backend Java code using the information provided in the class definitions file and the Team Lead's assigned task and also consider reading the code files from input . "
-                "Implement complete and production-ready Java backend code using the class details in the input files and the task from the Team Lead. "
-                "The code must include correct package declarations and necessary imports as per `code.txt`. Do not include any test code",
-    agent=developer_agent,
-    tools=[file_read_tool],
-    expected_output="Java code that implements the required functionality, without test logic.",
-    context=[TL_task],
-    input={
-        "code": "{{project_output/code.txt}}"
-    }
-)
+def assign_stories(stories: List[str]) -> str:
+    """Builds the Team Lead's development and testing assignments for each story."""
+    assignments = []
+    for story in stories:
+        title = story.splitlines()[0].lstrip("#").strip()
+        assignments.append(
+            f"### {title}\n"
+            f"Developer task ({title}): implement the backend changes required by this story.\n"
+            f"Tester task ({title}): write JUnit test cases that validate this story's functionality.\n\n"
+            f"{story}\n"
+        )
+    return "\n".join(assignments)
 
-developer_approve_task = Task(
-    description="Review the Java code written by the developer. Confirm if it meets the user story requirements and follows clean code practices. "
-                "Provide either approval or specific revision feedback.",
-    agent=developer_approver_agent,
-    expected_output="Approval confirmation or feedback for changes to the developer code.",
-    context=[TL_task, developer_task]
-)
+def write_if_approved(review: str, approved_output: str, output_file: str) -> str:
+    """Writes the approved output to output_file if the review approved it."""
+    if "approved" not in review.lower():
+        return f"Not approved, '{output_file}' was not written."
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(approved_output)
+    return f"Approved output written to '{output_file}'."
 
-tester_task = Task(
-    description="Generate detailed JUnit test cases for the backend functionality implemented by the developer and also consider reading the code files from input . "
-                "Use the TL’s task assignment and developer code to understand what to test.",
-    agent=tester_agent,
-    tools=[file_read_tool],
-    expected_output="A complete set of JUnit test cases validating the described functionality.",
-    context=[TL_task, developer_task],
-    input={
-        "code": "{{project_output/code.txt}}"
-    }
-)
+def apply_shared_prefix(pipeline: "CodePipeline", prefix: str):
+    for agent in pipeline.agents:
+        agent.system_template = prefix + "{{ .System }}"
+        agent.prompt_template = "{{ .Prompt }}"
+    for pipeline_llm in pipeline.llms:
+        pipeline_llm.shared_prefix = prefix
 
-tester_approve_task = Task(
-    description="Review the JUnit test cases for completeness, correctness, and alignment with the user story and implemented logic. "
-                "Approve them or suggest necessary improvements.",
-    agent=tester_approver_agent,
-    expected_output="Approval confirmation for test cases or detailed feedback for improvement.",
-    context=[TL_task, tester_task]
-)
+# -------------------- Pipeline --------------------
+# Tools, LLMs, agents, tasks and crews are built for every run rather than at import time.
+# They hold per-run state (prompt prefix, task callbacks and outputs), so concurrent
+# sessions must never share them.
 
-developer_write_task = Task(
-    description="If the code generated by the developer is approved, write the approved Java code to the 'developer_code.txt' file.",
-    agent=developer_agent,
-    expected_output="Java code written to 'developer_code.txt'.",
-    context=[developer_approve_task, developer_task],
-    output_file="project_output/developer_code.txt",
-    condition=lambda output: "approved" in output.lower()
-)
+class CodePipeline(NamedTuple):
+    agents: List[Agent]
+    llms: List[CachedLLM]
+    tl_task: Task
+    tl_crew: Crew
+    developer_crew: Crew
+    developer_review_crew: Crew
+    tester_crew: Crew
 
-tester_write_task = Task(
-    description="If the test cases generated by the tester are approved, write the approved JUnit test cases to the 'tester_code.txt' file.",
-    agent=tester_agent,
-    expected_output="Test cases written to 'tester_code.txt'.",
-    context=[tester_approve_task, tester_task],
-    output_file="project_output/tester_code.txt",
-    condition=lambda output: "approved" in output.lower()
-)
+def build_pipeline(on_task_complete: Optional[Callable[[TaskOutput], None]] = None) -> CodePipeline:
+    # Tool Initialization
+    file_read_tool = FileReadTool()
 
-# -------------------- Crew --------------------
+    # LLMs with keys from environment variables
+    llm = CachedLLM(
+        model='gemini/gemini-2.0-flash',
+        api_key=GEMINI_API_KEY_1
+    )
+    llm_new = CachedLLM(
+        model='gemini/gemini-2.0-flash',
+        api_key=GEMINI_API_KEY_2
+    )
 
-stories_imple_crew = Crew(
-    agents=[TL_agent, developer_agent, developer_approver_agent, tester_agent, tester_approver_agent],
-    tasks=[TL_task, developer_task, developer_approve_task, tester_task, tester_approve_task, developer_write_task, tester_write_task],
-    process=Process.sequential,
-    verbose=True
-)
+    # -------------------- Agents --------------------
+
+    TL_agent = Agent(
+        role="Team Lead",
+        goal="Analyze stories and break them into clear development and testing tasks.",
+        backstory="You're a tech-savvy Team Lead who understands both development and testing in Spring Boot applications. "
+                  "Your job is to read user stories from a file and assign specific tasks to the developer and tester based on the story requirements.",
+        llm=llm_new,
+        tools=[file_read_tool],
+        allow_delegation=True,
+        verbose=True
+    )
+
+    developer_agent = Agent(
+        role="Backend Developer",
+        goal="Generate Java Spring Boot code that meets the assigned user story requirements and code. Do not write test code.",
+        backstory="You're a backend developer specialized in Java, Spring Boot, and JPA. "
+                  "Based on tasks assigned by the Team Lead and class information from a file, your responsibility is to implement only the backend logic.",
+        llm=llm,
+        allow_delegation=False,
+        verbose=True
+    )
+
+    developer_approver_agent = Agent(
+        role="Code Reviewer",
+        goal="Evaluate and approve Java code submitted by the developer, ensuring it fulfills the user story and follows best practices.",
+        backstory="You're a senior software architect who reviews Java Spring Boot code. "
+                  "You ensure correctness, alignment with the story, and coding standards before approval.",
+        llm=llm_new,
+        allow_delegation=False,
+        verbose=True
+    )
+
+    tester_agent = Agent(
+        role="QA Engineer",
+        goal="Generate JUnit test cases based on the functionality implemented by the developer and tasks assigned by the Team Lead.",
+        backstory="You're a software tester with deep understanding of backend systems. "
+                  "Using class data and the developer's code, you create high-quality JUnit test cases.",
+        llm=llm,
+        allow_delegation=False,
+        verbose=True
+    )
+
+    tester_approver_agent = Agent(
+        role="Test Case Reviewer",
+        goal="Review the JUnit test cases to ensure they comprehensively validate the assigned functionality and follow best practices.",
+        backstory="You're a seasoned QA lead who checks if JUnit test cases are sufficient, accurate, and aligned with the user story and implementation.",
+        llm=llm_new,
+        allow_delegation=False,
+        verbose=True
+    )
+
+    agents = [TL_agent, developer_agent, developer_approver_agent, tester_agent, tester_approver_agent]
+
+    # -------------------- Tasks --------------------
+
+    TL_task = Task(
+        description="Read stories from the input file and assign tasks separately for development and testing. "
+                    "Ensure each task clearly refers to a specific story and includes enough detail for execution.",
+        agent=TL_agent,
+        callback=on_task_complete,
+        tools=[file_read_tool],
+        expected_output="Tasks assigned to developer and tester, indicating which story each task belongs to.",
+        input={
+            "user_stories": "{{myenv/output/stories.txt}}"
+        }
+    )
+
+    developer_task = Task(
+        description="Implement backend Java code using the information provided in the class definitions file and the Team Lead's assigned task and also consider reading the code files from input . "
+                    "Implement complete and production-ready Java backend code using the class details in the input files and the task from the Team Lead. "
+                    "The code must include correct package declarations and necessary imports as per `code.txt`. Do not include any test code",
+        agent=developer_agent,
+        callback=on_task_complete,
+        tools=[file_read_tool],
+        expected_output="Java code that implements the required functionality, without test logic.",
+        context=[TL_task],
+        input={
+            "code": "{{project_output/code.txt}}"
+        }
+    )
+
+    developer_approve_task = Task(
+        description="Review the Java code written by the developer. Confirm if it meets the user story requirements and follows clean code practices. "
+                    "Provide either approval or specific revision feedback.",
+        agent=developer_approver_agent,
+        callback=on_task_complete,
+        expected_output="Approval confirmation or feedback for changes to the developer code.",
+        context=[TL_task, developer_task]
+    )
+
+    tester_task = Task(
+        description="Generate detailed JUnit test cases for the backend functionality implemented by the developer and also consider reading the code files from input . "
+                    "Use the TL’s task assignment and developer code to understand what to test.",
+        agent=tester_agent,
+        callback=on_task_complete,
+        tools=[file_read_tool],
+        expected_output="A complete set of JUnit test cases validating the described functionality.",
+        context=[TL_task, developer_task],
+        input={
+            "code": "{{project_output/code.txt}}"
+        }
+    )
+
+    tester_approve_task = Task(
+        description="Review the JUnit test cases for completeness, correctness, and alignment with the user story and implemented logic. "
+                    "Approve them or suggest necessary improvements.",
+        agent=tester_approver_agent,
+        callback=on_task_complete,
+        expected_output="Approval confirmation for test cases or detailed feedback for improvement.",
+        context=[TL_task, tester_task]
+    )
+
+    # -------------------- Crews --------------------
+    # The TL crew is skipped when the stories can be split without an LLM.
+    # The review of the developer code and the tester branch only depend on the
+    # TL and developer tasks, so they run as two independent crews in parallel.
+    # The TL crew lists every agent so the Team Lead can still delegate to them.
+
+    tl_crew = Crew(
+        agents=agents,
+        tasks=[TL_task],
+        process=Process.sequential,
+        verbose=True
+    )
+
+    developer_crew = Crew(
+        agents=[developer_agent],
+        tasks=[developer_task],
+        process=Process.sequential,
+        verbose=True
+    )
+
+    developer_review_crew = Crew(
+        agents=[developer_approver_agent],
+        tasks=[developer_approve_task],
+        process=Process.sequential,
+        verbose=True
+    )
+
+    tester_crew = Crew(
+        agents=[tester_agent, tester_approver_agent],
+        tasks=[tester_task, tester_approve_task],
+        process=Process.sequential,
+        verbose=True
+    )
+
+    return CodePipeline(
+        agents=agents,
+        llms=[llm, llm_new],
+        tl_task=TL_task,
+        tl_crew=tl_crew,
+        developer_crew=developer_crew,
+        developer_review_crew=developer_review_crew,
+        tester_crew=tester_crew
+    )
 
 # -------------------- Run function --------------------
 
-def run_code_generation():
-    development_report = stories_imple_crew.kickoff()
-    return development_report
+async def run_code_generation(on_task_complete: Optional[Callable[[TaskOutput], None]] = None) -> str:
+    """
+    Runs the code generation crews.
+
+    Args:
+        on_task_complete: Called with each task's output as soon as the task finishes.
+            It runs on a crew worker thread, not on the caller's thread.
+    """
+    pipeline = build_pipeline(on_task_complete)
+    apply_shared_prefix(pipeline, build_shared_prefix())
+
+    stories = []
+    if os.path.exists(STORIES_FILE):
+        with open(STORIES_FILE, encoding="utf-8") as f:
+            stories = split_stories(f.read())
+
+    if stories:
+        # The stories are already split by heading, so assign them without the Team Lead LLM call
+        tl_task = pipeline.tl_task
+        tl_task.output = TaskOutput(
+            description=tl_task.description,
+            expected_output=tl_task.expected_output,
+            raw=assign_stories(stories),
+            agent=tl_task.agent.role
+        )
+        if on_task_complete:
+            on_task_complete(tl_task.output)
+    else:
+        await pipeline.tl_crew.kickoff_async()
+
+    developer_output = await pipeline.developer_crew.kickoff_async()
+    developer_review, tester_outputs = await asyncio.gather(
+        pipeline.developer_review_crew.kickoff_async(),
+        pipeline.tester_crew.kickoff_async()
+    )
+    tester_output, tester_review = tester_outputs.tasks_output
+
+    developer_result = write_if_approved(developer_review.raw, developer_output.raw, DEVELOPER_CODE_FILE)
+    tester_result = write_if_approved(tester_review.raw, tester_output.raw, TESTER_CODE_FILE)
+    return f"{developer_review}\n{developer_result}\n\n{tester_review}\n{tester_result}"
@@ -0,0 +1,34 @@
+import os
+from dotenv import load_dotenv
+
+# === Load environment variables from .env file (once, for every module) ===
+load_dotenv()
+
+# === AWS ===
+AWS_REGION = os.getenv('AWS_REGION')
+AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
+AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
+S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
+S3_PREFIX = os.getenv('S3_PREFIX')
+
+# Shared botocore.config.Config options for every boto3 client/resource
+BOTO_CONFIG_OPTIONS = {
+    'max_pool_connections': 32,
+    'retries': {'mode': 'adaptive', 'max_attempts': 5},
+    'tcp_keepalive': True
+}
+
+# === Local output ===
+LOCAL_OUTPUT_BASE = os.getenv('LOCAL_OUTPUT_BASE')
+
+# === Gemini / Google ===
+GEMINI_API_KEY_1 = os.getenv('GEMINI_API_KEY_1')
+GEMINI_API_KEY_2 = os.getenv('GEMINI_API_KEY_2')
+GOOGLE_API_KEY_1 = os.getenv('GOOGLE_API_KEY_1')
+GOOGLE_API_KEY_2 = os.getenv('GOOGLE_API_KEY_2')
+
+# === Pinecone ===
+PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
+
+# === LLM response cache ===
+DEVSTORYAI_NO_CACHE = os.getenv('DEVSTORYAI_NO_CACHE') == '1'
@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import pickle
+import time
+import threading
+from contextlib import closing
+from typing import Any, Dict, Iterable, Optional
+
+# Root folder for all on-disk caches
+CACHE_ROOT = os.path.expanduser("~/.devstoryai")
+
+# Keys per query in get_many, below SQLite's limit on bound parameters
+MAX_KEYS_PER_QUERY = 500
+
+
+class DiskCache:
+    """A small persistent key/value store backed by SQLite, with optional per-entry expiry."""
+
+    def __init__(self, name: str):
+        os.makedirs(CACHE_ROOT, exist_ok=True)
+        self.path = os.path.join(CACHE_ROOT, f"{name}.db")
+        self._lock = threading.Lock()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Returns the stored value for key, or default if it is missing or expired."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.execute("DELETE FROM cache WHERE key = ? AND expires_at < ?", (key, time.time()))
+            return default
+        return pickle.loads(value)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Returns {key: value} for every key that is stored and not expired, using one connection."""
+        keys = list(keys)
+        now = time.time()
+        found = {}
+        with closing(self._connect()) as conn:
+            for start in range(0, len(keys), MAX_KEYS_PER_QUERY):
+                batch = keys[start:start + MAX_KEYS_PER_QUERY]
+                placeholders = ", ".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, value, expires_at FROM cache WHERE key IN ({placeholders})", batch
+                )
+                for key, value, expires_at in rows:
+                    if expires_at is None or expires_at >= now:
+                        found[key] = pickle.loads(value)
+        return found
+
+    def set(self, key: str, value: Any, expire: Optional[float] = None):
+        """Stores value under key. `expire` is a lifetime in seconds (None keeps it forever)."""
+        expires_at = time.time() + expire if expire is not None else None
+        blob = pickle.dumps(value)
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, blob, expires_at)
+            )
+            # Drop entries that expired without being read again, so the file does not grow forever
+            conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+
+    def set_many(self, items: Dict[str, Any], expire: Optional[float] = None):
+        """Stores every key/value pair in items in a single transaction."""
+        if not items:
+            return
+        expires_at = time.time() + expire if expire is not None else None
+        rows = [(key, pickle.dumps(value), expires_at) for key, value in items.items()]
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", rows)
+            conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
@@ -1,31 +1,66 @@
+import io
 import os
-import json
+import asyncio
+import hashlib
 import logging
-from typing import Dict, List, Optional, Union
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
 from javalang.parse import parse
 from javalang.tree import (
     ClassDeclaration, InterfaceDeclaration, MethodDeclaration, FieldDeclaration,
     MemberReference, MethodInvocation, VariableDeclarator, Type, ClassCreator
 )
+import orjson
 from github import Github
-import requests
+import httpx
 import boto3
-from dotenv import load_dotenv
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from disk_cache import DiskCache
+from config import (
+    AWS_REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME, S3_PREFIX, LOCAL_OUTPUT_BASE,
+    BOTO_CONFIG_OPTIONS
+)
+
+# A tuple so str.startswith can check every prefix in one call
+STANDARD_LIBRARIES = ('System', 'log', 'e')
+
+# Maximum number of GitHub blob requests in flight at once
+MAX_CONCURRENT_FETCHES = 10
 
-# Load environment variables from .env file
-load_dotenv()
+# GitHub blob requests are retried on connection errors, server errors and rate-limit responses
+MAX_FETCH_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 0.5
+MAX_RETRY_DELAY_SECONDS = 60
 
-STANDARD_LIBRARIES = {'System', 'log', 'e'}
+# Tree listings are cached briefly; blobs never change, but expire so the cache stays bounded
+TREE_CACHE_TTL = 5 * 60
+BLOB_CACHE_TTL = 30 * 24 * 60 * 60
+
+# Metadata larger than this is uploaded to S3 in parallel multipart chunks
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Initialize boto3 S3 client with credentials from environment variables
-s3_client = boto3.client(
-    's3',
-    region_name=os.getenv('AWS_REGION'),
-    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-)
+# On-disk caches for GitHub data and finished analyses
+_tree_cache = DiskCache("gh_trees")
+_blob_cache = DiskCache("gh_blobs")
+_analysis_cache = DiskCache("analyses")
+
+# The raw media type returns the file bytes directly instead of base64 JSON
+GITHUB_RAW_MEDIA_TYPE = 'application/vnd.github.raw'
+
+@lru_cache(maxsize=1)
+def get_s3_client():
+    """Creates the boto3 S3 client (with credentials from environment variables) on first use."""
+    return boto3.client(
+        's3',
+        region_name=AWS_REGION,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        config=Config(**BOTO_CONFIG_OPTIONS)
+    )
 
 def parse_java_file(file_content: str) -> Union[ClassDeclaration, InterfaceDeclaration]:
     """Parses the content of a Java file and returns the AST."""
@@ -33,23 +68,25 @@ def parse_java_file(file_content: str) -> Union[ClassDeclaration, InterfaceDecla
 
 def is_standard_library_call(method_call: str) -> bool:
     """Checks if a method call is a standard library call."""
-    return any(method_call.startswith(lib) for lib in STANDARD_LIBRARIES)
+    return method_call.startswith(STANDARD_LIBRARIES)
 
 def extract_method_calls(method_node: MethodDeclaration) -> List[str]:
     """Extracts method calls from a method node."""
     calls = []
+    append = calls.append
     for _, child in method_node:
-        if isinstance(child, MethodInvocation):
-            method_call = child.member
-            if child.qualifier:
-                qualifier = child.qualifier
-                if isinstance(qualifier, MemberReference):
-                    qualifier = qualifier.member
-                elif isinstance(qualifier, ClassCreator) and isinstance(qualifier.type, Type):
-                    qualifier = qualifier.type.name
-                method_call = f"{qualifier}.{method_call}"
-            if not is_standard_library_call(method_call):
-                calls.append(method_call)
+        if not isinstance(child, MethodInvocation):
+            continue
+        method_call = child.member
+        qualifier = child.qualifier
+        if qualifier:
+            if isinstance(qualifier, MemberReference):
+                qualifier = qualifier.member
+            elif isinstance(qualifier, ClassCreator) and isinstance(qualifier.type, Type):
+                qualifier = qualifier.type.name
+            method_call = f"{qualifier}.{method_call}"
+        if not is_standard_library_call(method_call):
+            append(method_call)
     return calls
 
 def get_type_name(type_node: Optional[Type]) -> Optional[str]:
@@ -60,169 +97,287 @@ def extract_relationships(tree: Union[ClassDeclaration, InterfaceDeclaration], f
     """Extracts relationships (class/interface definitions, attributes, methods, calls) from a Java AST."""
     relationships = []
     for _, node in tree:
-        if isinstance(node, (ClassDeclaration, InterfaceDeclaration)):
-            node_type = 'class' if isinstance(node, ClassDeclaration) else 'interface'
-            name = node.name
-            extends = [get_type_name(ext) for ext in node.extends] if hasattr(node, 'extends') and node.extends else None
-            implements = [get_type_name(impl) for impl in node.implements] if hasattr(node, 'implements') and node.implements else []
-            attributes = [
-                {
-                    'name': declarator.name,
-                    'type': get_type_name(member.type),
-                    'modifiers': list(member.modifiers)
-                }
-                for member in node.body if isinstance(member, FieldDeclaration)
-                for declarator in member.declarators if isinstance(declarator, VariableDeclarator)
-            ]
-            methods = {
-                member.name: {
+        if not isinstance(node, (ClassDeclaration, InterfaceDeclaration)):
+            continue
+        node_type = 'class' if isinstance(node, ClassDeclaration) else 'interface'
+        extends = [get_type_name(ext) for ext in node.extends] if node.extends else None
+        # Interfaces have no 'implements' attribute
+        node_implements = getattr(node, 'implements', None)
+        implements = [get_type_name(impl) for impl in node_implements] if node_implements else None
+
+        # Collect fields and methods in a single pass over the class body.
+        # isinstance is kept (not an exact type check) so ConstantDeclaration fields still count.
+        attributes = []
+        methods = {}
+        for member in node.body:
+            if isinstance(member, FieldDeclaration):
+                field_type = get_type_name(member.type)
+                for declarator in member.declarators:
+                    if isinstance(declarator, VariableDeclarator):
+                        attributes.append({
+                            'name': declarator.name,
+                            'type': field_type,
+                            'modifiers': list(member.modifiers)
+                        })
+            elif isinstance(member, MethodDeclaration):
+                methods[member.name] = {
                     'calls': extract_method_calls(member),
                     'parameters': [{'name': p.name, 'type': get_type_name(p.type), 'modifiers': list(p.modifiers)} for p in member.parameters],
                     'return_type': get_type_name(member.return_type),
                     'modifiers': list(member.modifiers)
                 }
-                for member in node.body if isinstance(member, MethodDeclaration)
-            }
-
-            relationships.append({
-                'className': name,
-                'type': node_type,
-                'classPath': file_path,
-                'extends': extends if extends else None,
-                'implements': implements if implements else None,
-                'attributes': attributes if attributes else None,
-                'methods': methods if methods else None
-            })
+
+        relationships.append({
+            'className': node.name,
+            'type': node_type,
+            'classPath': file_path,
+            'extends': extends if extends else None,
+            'implements': implements,
+            'attributes': attributes if attributes else None,
+            'methods': methods if methods else None
+        })
     return relationships
 
-def save_relationships_to_local(relationships: List[Dict], local_file_path: str):
-    """Saves the extracted relationships to a JSON file."""
+def parse_and_extract(file: Tuple[str, str]) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Parses one Java file and extracts its relationships. Runs inside a worker process,
+    so only the (small) relationship list is sent back, never the AST.
+
+    Returns:
+        tuple: The extracted relationships and an error message if parsing failed.
+    """
+    file_content, file_path = file
+    try:
+        tree = parse_java_file(file_content)
+        return extract_relationships(tree, file_path), None
+    except Exception as e:
+        # javalang's JavaSyntaxError has an empty message, so always include the exception type
+        return [], f"{type(e).__name__}: {e}"
+
+def save_relationships_to_local(relationships_json: bytes, local_file_path: str):
+    """Saves the serialized relationships to a JSON file."""
     try:
         # Ensure the directory exists
         os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-        with open(local_file_path, 'w') as f:
-            json.dump(relationships, f, indent=4)
+        with open(local_file_path, 'wb') as f:
+            f.write(relationships_json)
         logging.info(f"JSON metadata saved locally to: {local_file_path}")
     except Exception as e:
         logging.error(f"Error saving JSON metadata locally: {e}")
 
-def find_java_files_in_github(repo_url, github_token):
+def parse_repo_url(repo_url: str) -> Tuple[str, str]:
+    """Extracts the owner and repository name from a GitHub repository URL."""
+    parts = repo_url.rstrip("/").split("/")
+    return parts[-2], parts[-1].replace(".git", "")
+
+def get_default_branch_commit_sha(repo_url: str, github_token: str) -> Optional[str]:
+    """Returns the SHA of the latest commit on the repository's default branch, or None if it cannot be read."""
+    try:
+        owner, repo_name = parse_repo_url(repo_url)
+        repo = Github(github_token).get_repo(f"{owner}/{repo_name}")
+        return repo.get_branch(repo.default_branch).commit.sha
+    except Exception as e:
+        logging.error(f"An error occurred while reading the latest commit: {e}")
+        return None
+
+def find_java_files_in_github(repo_url, github_token, commit_sha=None):
     """
     Finds all .java files in a GitHub repository without cloning it locally using the PyGithub library.
 
     Args:
         repo_url (str): The URL of the GitHub repository (e.g., "https://github.com/owner/repo").
         github_token (str): Your GitHub personal access token.
+        commit_sha (str): The commit to list, if the caller already knows it. Defaults to the
+                          latest commit on the default branch.
 
     Returns:
-        list: A list of file paths with the ".java" extension found in the repository,
+        list: A list of (path, blob sha) tuples for the ".java" files found in the repository,
               or None if an error occurred.
     """
     try:
-        # Extract owner and repository name from the URL
-        parts = repo_url.split("/")
-        owner = parts[-2]
-        repo_name = parts[-1].replace(".git", "")
+        owner, repo_name = parse_repo_url(repo_url)
+
+        # A lazy repository makes no request until one is needed, so a known commit skips the repo lookup
+        repo = Github(github_token).get_repo(f"{owner}/{repo_name}", lazy=commit_sha is not None)
+        if commit_sha is None:
+            commit_sha = repo.get_branch(repo.default_branch).commit.sha
 
-        g = Github(github_token)
-        repo = g.get_repo(f"{owner}/{repo_name}")
+        # The listing for a commit never changes, so reuse it while it is cached
+        tree_key = f"{owner}/{repo_name}@{commit_sha}"
+        java_files = _tree_cache.get(tree_key)
+        if java_files is not None:
+            return java_files
 
         java_files = []
-        contents = repo.get_git_tree(repo.default_branch, recursive=True).tree
+        contents = repo.get_git_tree(commit_sha, recursive=True).tree
         for item in contents:
             if item.type == 'blob' and item.path.endswith('.java'):
-                java_files.append(item.path)
+                java_files.append((item.path, item.sha))
+        _tree_cache.set(tree_key, java_files, expire=TREE_CACHE_TTL)
         return java_files
 
     except Exception as e:
         logging.error(f"An error occurred while listing Java files: {e}")
         return None
 
-def get_file_content(repo_url, file_path, github_token):
+def should_retry(response: httpx.Response) -> bool:
+    """Returns True for server errors and GitHub rate-limit responses, which can succeed when retried."""
+    if response.status_code >= 500:
+        return True
+    return response.status_code in (403, 429) and (
+        'retry-after' in response.headers or response.headers.get('x-ratelimit-remaining') == '0'
+    )
+
+async def get_with_retries(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    """GETs url, backing off exponentially (or for GitHub's Retry-After) while should_retry() says so."""
+    for attempt in range(MAX_FETCH_RETRIES):
+        response = await client.get(url)
+        if not should_retry(response):
+            return response
+        delay = RETRY_BACKOFF_SECONDS * 2 ** attempt
+        retry_after = response.headers.get('retry-after', '')
+        if retry_after.isdigit():
+            delay = min(int(retry_after), MAX_RETRY_DELAY_SECONDS)
+        logging.warning(f"GitHub returned {response.status_code} for {url}, retrying in {delay}s")
+        await asyncio.sleep(delay)
+    return await client.get(url)
+
+async def fetch_blob_content(client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                             owner: str, repo_name: str, sha: str) -> str:
+    """Fetches a single blob from the GitHub git data API."""
+    async with semaphore:
+        response = await get_with_retries(client, f"https://api.github.com/repos/{owner}/{repo_name}/git/blobs/{sha}")
+    response.raise_for_status()
+    return response.content.decode('utf-8')
+
+async def fetch_all_file_contents(repo_url: str, java_files: List[Tuple[str, str]],
+                                  github_token: str) -> List[Union[str, BaseException]]:
     """
-    Retrieves the content of a file from a GitHub repository.
-
-    Args:
-        repo_url (str): The URL of the GitHub repository.
-        file_path (str): The path to the file within the repository.
-        github_token (str): Your GitHub personal access token.
+    Fetches the contents of all files concurrently using their blob SHAs.
+    Cached blobs are read in one query and newly fetched ones written in one transaction.
 
     Returns:
-        str: The content of the file, or None if an error occurs.
+        list: The decoded content of each file, in the same order as java_files,
+              or the exception raised while fetching it.
     """
-    try:
-        parts = repo_url.split("/")
-        owner = parts[-2]
-        repo_name = parts[-1].replace(".git", "")
-
-        headers = {}
-        if github_token:
-            headers['Authorization'] = f'token {github_token}'
-
-        # Construct the API URL to get the file contents.
-        api_url = f"https://api.github.com/repos/{owner}/{repo_name}/contents/{file_path}"
-        response = requests.get(api_url, headers=headers)
-        response.raise_for_status()  # Raise an exception for bad status codes
-
-        content = response.json()['content']
-        # The content is base64 encoded, so decode it.
-        import base64
-        return base64.b64decode(content).decode('utf-8')
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error fetching {file_path} from GitHub: {e}")
-        return None
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {e}")
-        return None
-
-def save_json_to_s3(user_id: str, local_output_path: str, project_name: str) -> Optional[str]:
-    S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
-    S3_PREFIX = os.getenv('S3_PREFIX')
+    owner, repo_name = parse_repo_url(repo_url)
+    headers = {'Accept': GITHUB_RAW_MEDIA_TYPE}
+    if github_token:
+        headers['Authorization'] = f'token {github_token}'
+
+    shas = [sha for _, sha in java_files]
+    contents = _blob_cache.get_many(shas)
+    missing = [sha for sha in dict.fromkeys(shas) if sha not in contents]
+
+    if missing:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+        # The transport retries failed connections; get_with_retries() handles error responses
+        transport = httpx.AsyncHTTPTransport(http2=True, retries=MAX_FETCH_RETRIES)
+        async with httpx.AsyncClient(headers=headers, transport=transport, timeout=30) as client:
+            fetched = await asyncio.gather(
+                *[fetch_blob_content(client, semaphore, owner, repo_name, sha) for sha in missing],
+                return_exceptions=True
+            )
+        contents.update(zip(missing, fetched))
+        _blob_cache.set_many(
+            {sha: content for sha, content in zip(missing, fetched) if not isinstance(content, BaseException)},
+            expire=BLOB_CACHE_TTL
+        )
+
+    return [contents[sha] for sha in shas]
+
+def save_json_to_s3(user_id: str, relationships_json: bytes, project_name: str) -> Optional[str]:
     s3_prefix = f"{S3_PREFIX}{user_id}/{project_name}/"
     s3_key = os.path.join(s3_prefix, f"{project_name}_metadata.json")  # Use project_name in filename for clarity
     s3_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
 
     try:
-        s3_client.upload_file(local_output_path, S3_BUCKET_NAME, s3_key)
-        logging.info(f"Uploaded {local_output_path} to s3://{S3_BUCKET_NAME}/{s3_key}")
+        # Upload the bytes already in memory instead of re-reading the local file
+        s3_client = get_s3_client()
+        if len(relationships_json) > MULTIPART_THRESHOLD:
+            s3_client.upload_fileobj(
+                io.BytesIO(relationships_json), S3_BUCKET_NAME, s3_key,
+                ExtraArgs={'ContentType': 'application/json'},
+                Config=TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, use_threads=True)
+            )
+        else:
+            s3_client.put_object(
+                Bucket=S3_BUCKET_NAME, Key=s3_key, Body=relationships_json, ContentType='application/json'
+            )
+        logging.info(f"Uploaded metadata to s3://{S3_BUCKET_NAME}/{s3_key}")
         return s3_url
     except Exception as e:
-        logging.error(f"Error uploading {local_output_path} to S3: {e}")
+        logging.error(f"Error uploading metadata to S3: {e}")
         return None
 
-def analyze_java_project(git_url: str, git_token: str,project_name: str, user_id: str) -> Optional[str]:
-    """Analyzes a Java project directly from a GitHub repository."""
+def get_files_fingerprint(java_files: List[Tuple[str, str]]) -> str:
+    """Returns a hash that only changes when a file is added, removed, renamed or modified."""
+    digest = hashlib.sha256()
+    for path, sha in sorted(java_files):
+        digest.update(f"{path}:{sha}\n".encode('utf-8'))
+    return digest.hexdigest()
 
-    local_output_base = os.getenv('LOCAL_OUTPUT_BASE')
-    local_output_path = os.path.join(local_output_base, project_name, "relationship.json")
+class AnalysisResult(NamedTuple):
+    s3_url: Optional[str]
+    # False when some files could not be downloaded, so the metadata must not be reused
+    complete: bool
 
-    java_files = find_java_files_in_github(git_url, git_token)
+def analyze_java_project(git_url: str, git_token: str,project_name: str, user_id: str,
+                         commit_sha: Optional[str] = None) -> AnalysisResult:
+    """Analyzes a Java project directly from a GitHub repository, at commit_sha if it is given."""
+
+    local_output_path = os.path.join(LOCAL_OUTPUT_BASE, project_name, "relationship.json")
+
+    java_files = find_java_files_in_github(git_url, git_token, commit_sha)
     if not java_files:
         logging.error("No Java files found or unable to list files.")
-        return None
+        return AnalysisResult(None, False)
+
+    # The S3 key only depends on the user and project, so the upload is reusable only
+    # while the sources still match the ones that were uploaded last
+    analysis_key = f"{user_id}/{project_name}"
+    fingerprint = get_files_fingerprint(java_files)
+    last_analysis = _analysis_cache.get(analysis_key)
+    if last_analysis is not None and last_analysis[0] == fingerprint:
+        cached_url = last_analysis[1]
+        logging.info(f"Java sources unchanged since the last analysis, reusing {cached_url}")
+        return AnalysisResult(cached_url, True)
 
     all_relationships = []
-
-    for file_path in java_files:
-        try:
-            file_content = get_file_content(git_url, file_path, git_token)
-            if file_content:
-                tree = parse_java_file(file_content)
-                relationships = extract_relationships(tree, file_path)
-                all_relationships.extend(relationships)
+    file_contents = asyncio.run(fetch_all_file_contents(git_url, java_files, git_token))
+
+    files = []
+    # Download failures are usually transient, so an analysis that misses files is not reused
+    all_fetched = True
+    for (file_path, _), file_content in zip(java_files, file_contents):
+        if isinstance(file_content, BaseException):
+            logging.error(f"Error fetching {file_path} from GitHub: {file_content}")
+            all_fetched = False
+        elif file_content:
+            files.append((file_content, file_path))
+        else:
+            logging.error(f"Could not retrieve content for {file_path}. Skipping.")
+
+    # javalang parsing is CPU-bound, so spread it over all cores
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(parse_and_extract, files, chunksize=4)
+        for (_, file_path), (relationships, error) in zip(files, results):
+            if error is not None:
+                logging.error(f"Error processing {file_path}: {error}")
             else:
-                logging.error(f"Could not retrieve content for {file_path}. Skipping.")
-
-        except Exception as e:
-            logging.error(f"Error processing {file_path}: {e}")
+                all_relationships.extend(relationships)
 
     if all_relationships:
-        save_relationships_to_local(all_relationships, local_output_path)
-        s3_url = save_json_to_s3(user_id, local_output_path, project_name)
-        return s3_url
+        relationships_json = orjson.dumps(all_relationships, option=orjson.OPT_INDENT_2)
+        save_relationships_to_local(relationships_json, local_output_path)
+        s3_url = save_json_to_s3(user_id, relationships_json, project_name)
+        if s3_url:
+            # The upload replaced the S3 object, so always replace the entry; a partial analysis
+            # is stored without a fingerprint so that no later run reuses it
+            _analysis_cache.set(analysis_key, (fingerprint if all_fetched else None, s3_url))
+        return AnalysisResult(s3_url, all_fetched)
     else:
         logging.info("No relationships extracted.")
-        return None
+        return AnalysisResult(None, all_fetched)
 
 
@@ -0,0 +1,183 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
+import httpx
+from crewai import LLM
+
+from disk_cache import DiskCache
+from config import DEVSTORYAI_NO_CACHE
+
+# Cached responses are reused for 24 hours
+LLM_CACHE_TTL = 24 * 60 * 60
+
+# Calls at or below this temperature are treated as deterministic and cached
+DETERMINISTIC_TEMPERATURE = 0.01
+
+# Gemini only accepts context caches of at least 4096 tokens. Prose can average more than
+# 4 characters per token, so only prefixes twice that estimate are cached
+MIN_SHARED_PREFIX_CHARS = 4096 * 4 * 2
+
+# Gemini context caches for the shared prefix are billed while they live, so keep them short
+PREFIX_CACHE_TTL = 5 * 60
+# A cache this close to expiring is recreated, so it cannot expire during the request
+PREFIX_CACHE_MARGIN = 30
+GEMINI_CACHED_CONTENTS_URL = "https://generativelanguage.googleapis.com/v1beta/cachedContents"
+
+_llm_cache: Optional[DiskCache] = None
+
+# Context caches created in this process: key -> (cache name, expiry time).
+# An empty name marks a prefix Gemini refused to cache, which is not retried until expiry
+_prefix_caches: Dict[str, Tuple[str, float]] = {}
+_prefix_caches_lock = threading.Lock()
+
+# The context cache used by the LLM call running on this thread
+_call_options = threading.local()
+
+
+def _get_cache() -> DiskCache:
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = DiskCache("llm_cache")
+    return _llm_cache
+
+
+def _tool_names(tools: Optional[List[dict]]) -> List[str]:
+    """Gets the function names from a list of tool schemas."""
+    names = []
+    for schema in tools or []:
+        function = schema.get("function", schema)
+        names.append(str(function.get("name")))
+    return sorted(names)
+
+
+class CachedLLM(LLM):
+    """A crewai LLM that stores deterministic completions on disk and replays them for identical requests.
+
+    Set DEVSTORYAI_NO_CACHE=1 to bypass the cache.
+
+    When shared_prefix is set and a prompt starts with it, the prefix is stored once in a
+    short-lived Gemini context cache and each call only sends the rest of the prompt. If the
+    context cache cannot be used, the call is sent again with the full prompt.
+    """
+
+    shared_prefix: Optional[str] = None
+
+    def _is_cacheable(self, available_functions: Optional[Dict[str, Any]]) -> bool:
+        if DEVSTORYAI_NO_CACHE:
+            return False
+        # Tool calls executed through available_functions have side effects, so always run them
+        if available_functions:
+            return False
+        return self.temperature is not None and self.temperature <= DETERMINISTIC_TEMPERATURE
+
+    def _cache_key(self, messages: Union[str, List[Dict[str, str]]], tools: Optional[List[dict]]) -> str:
+        payload = json.dumps(
+            {
+                "model": self.model,
+                "messages": messages,
+                "tools": _tool_names(tools),
+                "temperature": self.temperature
+            },
+            sort_keys=True,
+            default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _without_shared_prefix(self, messages: Union[str, List[Dict[str, str]]]) -> Optional[List[Dict[str, str]]]:
+        """Returns messages with the shared prefix removed, or None if they do not start with it."""
+        prefix = self.shared_prefix
+        if not prefix or len(prefix) < MIN_SHARED_PREFIX_CHARS or isinstance(messages, str) or not messages:
+            return None
+        content = messages[0].get("content")
+        if not isinstance(content, str) or not content.startswith(prefix):
+            return None
+        # Gemini rejects a system instruction next to cached content, so the rest of the
+        # system prompt is sent as a user turn
+        return [{"role": "user", "content": content[len(prefix):]}, *messages[1:]]
+
+    def _prefix_cache_key(self, prefix: str) -> str:
+        return hashlib.sha256(f"{self.model}\n{self.api_key}\n{prefix}".encode("utf-8")).hexdigest()
+
+    def _prefix_cache_name(self, prefix: str) -> str:
+        """Returns the name of a Gemini context cache holding prefix, creating it with PREFIX_CACHE_TTL if needed."""
+        key = self._prefix_cache_key(prefix)
+        with _prefix_caches_lock:
+            name, expires_at = _prefix_caches.get(key, (None, 0.0))
+            if name is None or expires_at - PREFIX_CACHE_MARGIN < time.time():
+                response = httpx.post(
+                    GEMINI_CACHED_CONTENTS_URL,
+                    params={"key": self.api_key},
+                    json={
+                        "model": f"models/{self.model.split('/', 1)[-1]}",
+                        "systemInstruction": {"parts": [{"text": prefix}]},
+                        "ttl": f"{PREFIX_CACHE_TTL}s"
+                    },
+                    timeout=30
+                )
+                response.raise_for_status()
+                name, expires_at = response.json()["name"], time.time() + PREFIX_CACHE_TTL
+                _prefix_caches[key] = (name, expires_at)
+        return name
+
+    def _prepare_completion_params(self, messages: Union[str, List[Dict[str, str]]],
+                                   tools: Optional[List[dict]] = None) -> Dict[str, Any]:
+        params = super()._prepare_completion_params(messages, tools)
+        cached_content = getattr(_call_options, "cached_content", None)
+        if cached_content:
+            params["cached_content"] = cached_content
+        return params
+
+    def _complete(
+        self,
+        messages: Union[str, List[Dict[str, str]]],
+        tools: Optional[List[dict]],
+        callbacks: Optional[List[Any]],
+        available_functions: Optional[Dict[str, Any]],
+        **kwargs
+    ) -> Union[str, Any]:
+        # Tool calls could run twice if the cached attempt failed halfway, so they never use the context cache
+        rest = None if tools or available_functions else self._without_shared_prefix(messages)
+        if rest is not None:
+            try:
+                _call_options.cached_content = self._prefix_cache_name(self.shared_prefix)
+                if _call_options.cached_content:
+                    return super().call(rest, tools, callbacks, available_functions, **kwargs)
+            except Exception as e:
+                logging.warning(f"Gemini context cache unavailable, sending the full prompt: {e}")
+                with _prefix_caches_lock:
+                    _prefix_caches[self._prefix_cache_key(self.shared_prefix)] = ("", time.time() + PREFIX_CACHE_TTL)
+            finally:
+                _call_options.cached_content = None
+        return super().call(messages, tools, callbacks, available_functions, **kwargs)
+
+    def call(
+        self,
+        messages: Union[str, List[Dict[str, str]]],
+        tools: Optional[List[dict]] = None,
+        callbacks: Optional[List[Any]] = None,
+        available_functions: Optional[Dict[str, Any]] = None,
+        **kwargs
+    ) -> Union[str, Any]:
+        if not self._is_cacheable(available_functions):
+            return self._complete(messages, tools, callbacks, available_functions, **kwargs)
+
+        key = self._cache_key(messages, tools)
+        try:
+            cached = _get_cache().get(key)
+        except Exception as e:
+            logging.warning(f"LLM cache lookup failed: {e}")
+            cached = None
+        if cached is not None:
+            logging.info(f"LLM cache hit for {self.model}")
+            return cached
+
+        response = self._complete(messages, tools, callbacks, available_functions, **kwargs)
+        if isinstance(response, str) and response:
+            try:
+                _get_cache().set(key, response, expire=LLM_CACHE_TTL)
+            except Exception as e:
+                logging.warning(f"LLM cache write failed: {e}")
+        return response
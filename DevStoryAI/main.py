@@ -1,23 +1,50 @@
+import asyncio
+import logging
 import streamlit as st
-import boto3
-from dotenv import load_dotenv # Import load_dotenv
-import os # Import os for environment variables
-
-from java_analyzer import analyze_java_project
-from stories import run_story_generation
-from CodeGenerator import run_code_generation
-
-# === Load environment variables from .env file ===
-load_dotenv()
-
-# === DynamoDB Setup ===
-dynamodb = boto3.resource(
-    'dynamodb',
-    region_name=os.getenv('AWS_REGION'),
-    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-)
-table = dynamodb.Table('project_details')
+
+from config import AWS_REGION, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, BOTO_CONFIG_OPTIONS
+
+# Heavy SDKs (boto3, crewai, langchain, pinecone, github) are imported inside the handlers
+# that need them, so Streamlit reruns of the page stay fast.
+
+# === DynamoDB Setup (created once, on first use) ===
+@st.cache_resource
+def get_project_table():
+    import boto3
+    from botocore.config import Config
+    dynamodb = boto3.resource(
+        'dynamodb',
+        region_name=AWS_REGION,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        config=Config(**BOTO_CONFIG_OPTIONS)
+    )
+    return dynamodb.Table('project_details')
+
+def get_stored_project(user_id: str, project_name: str):
+    """Returns the saved DynamoDB row for this project, or None if there is none."""
+    try:
+        response = get_project_table().get_item(Key={'ID': user_id, 'project_name': project_name})
+        return response.get('Item')
+    except Exception as e:
+        logging.warning(f"Error reading project {project_name} from DynamoDB: {e}")
+        return None
+
+# === Code Generation with live progress ===
+async def generate_code_with_progress(status) -> str:
+    from CodeGenerator import run_code_generation
+
+    loop = asyncio.get_running_loop()
+
+    def show_progress(output):
+        status.update(label=f"{output.agent} finished, continuing...", state="running")
+        status.write(f"✅ **{output.agent}**: {output.summary}")
+
+    # Task callbacks run on crew worker threads; hand them to this (script) thread to draw
+    def on_task_complete(output):
+        loop.call_soon_threadsafe(show_progress, output)
+
+    return await run_code_generation(on_task_complete)
 
 # === UI Setup ===
 st.set_page_config(page_title="DevStoryAI", layout="centered")
@@ -34,19 +61,36 @@ with st.form("project_form"):
 if submitted:
     if user_id and git_path and git_token and project_name:
         with st.spinner("Analyzing project..."):
-            s3_metadata_url = analyze_java_project(git_path, git_token, project_name, user_id)
+            from java_analyzer import analyze_java_project, get_default_branch_commit_sha
+
+            # Reuse the stored metadata when the repo has no new commits since it was analyzed
+            commit_sha = get_default_branch_commit_sha(git_path, git_token)
+            stored_project = get_stored_project(user_id, project_name)
+            analysis_complete = True
+            if (commit_sha and stored_project
+                    and stored_project.get('git_path') == git_path
+                    and stored_project.get('commit_sha') == commit_sha):
+                s3_metadata_url = stored_project.get('json_path')
+            else:
+                s3_metadata_url, analysis_complete = analyze_java_project(
+                    git_path, git_token, project_name, user_id, commit_sha
+                )
 
             if s3_metadata_url:
                 try:
-                    table.put_item(
-                        Item={
-                            'ID': user_id,
-                            'git_path': git_path,
-                            'git_token': git_token,
-                            'project_name': project_name,
-                            'json_path': s3_metadata_url
-                        }
-                    )
+                    item = {
+                        'ID': user_id,
+                        'git_path': git_path,
+                        'git_token': git_token,
+                        'project_name': project_name,
+                        'json_path': s3_metadata_url
+                    }
+                    # A partial analysis must not be reused for the whole commit
+                    if commit_sha and analysis_complete:
+                        item['commit_sha'] = commit_sha
+                    # Only write when something changed since the stored row
+                    if item != stored_project:
+                        get_project_table().put_item(Item=item)
                     st.success(f"✅ Project '{project_name}' analyzed successfully!")
                     st.markdown(f"📦 [View JSON Metadata]({s3_metadata_url})", unsafe_allow_html=True)
 
@@ -69,6 +113,7 @@ if st.session_state.get("chat_ready"):
     user_query = st.text_input("Ask your question about the project", key="user_query")
     if st.button("Get Impacted Classes and Stories"):
         with st.spinner("Processing your query with CrewAI..."):
+            from stories import run_story_generation
             result = run_story_generation(
                 user_query=user_query,
                 git_path=st.session_state["git_path"],
@@ -81,8 +126,9 @@ if st.session_state.get("chat_ready"):
     st.header("🛠️ Code Generation from Stories")
 
     if st.button("Assign Stories to Developers and Testers & Generate Code"):
-        with st.spinner("Assigning stories and generating code & tests..."):
-            codegen_report = run_code_generation()
-            st.success("✅ Code generation completed!")
-            st.subheader("📝 Code Generation Report")
-            st.text(codegen_report)
\ No newline at end of file
+        with st.status("Assigning stories and generating code & tests...", expanded=True) as status:
+            codegen_report = asyncio.run(generate_code_with_progress(status))
+            status.update(label="Code generation completed", state="complete")
+        st.success("✅ Code generation completed!")
+        st.subheader("📝 Code Generation Report")
+        st.text(codegen_report)
\ No newline at end of file
@@ -1,5 +1,5 @@
 # === Imports ===
-from crewai import Agent, Task, Crew, Process, LLM
+from crewai import Agent, Task, Crew, Process
 from crewai.tools import tool
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_pinecone import PineconeVectorStore
@@ -7,18 +7,34 @@ from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate
 from github import Github
+from github.Repository import Repository
+from urllib3.util.retry import Retry
 from pinecone import Pinecone
 import os
+import re
 import ast
-from dotenv import load_dotenv # Import load_dotenv
-
-# === Load environment variables from .env file ===
-load_dotenv()
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from llm_cache import CachedLLM
+from config import GOOGLE_API_KEY_1, GOOGLE_API_KEY_2, PINECONE_API_KEY
 
 # === Dynamic Global Vars ===
 repo_url = ""
 token = ""
 
+# === GitHub Repository (one client and metadata request per repo/token) ===
+@lru_cache(maxsize=4)
+def _get_repo(repo_url: str, token: str) -> Repository:
+    parts = repo_url.rstrip("/").replace(".git", "").split('/')
+    owner, repo_name = parts[-2], parts[-1]
+
+    g = Github(token, per_page=100, retry=Retry(total=3, backoff_factor=0.2))
+    return g.get_repo(f"{owner}/{repo_name}")
+
+@lru_cache(maxsize=4)
+def _get_default_branch(repo_url: str, token: str) -> str:
+    return _get_repo(repo_url, token).default_branch
+
 # === GitHub File Reader Tool ===
 @tool("read_github_files")
 def read_github_files(file_path: str):
@@ -28,14 +44,8 @@ def read_github_files(file_path: str):
     """
     global token, repo_url
     try:
-        parts = repo_url.rstrip("/").replace(".git", "").split('/')
-        owner, repo_name = parts[-2], parts[-1]
-
-        g = Github(token)
-        repo = g.get_repo(f"{owner}/{repo_name}")
-
-        branch = repo.default_branch
-        file = repo.get_contents(file_path, ref=branch)
+        repo = _get_repo(repo_url, token)
+        file = repo.get_contents(file_path, ref=_get_default_branch(repo_url, token))
         return file.decoded_content.decode("utf-8")
     except Exception as e:
         return f"Error: {str(e)}"
@@ -43,22 +53,20 @@ def read_github_files(file_path: str):
 git_reader = read_github_files
 
 # === Pinecone Setup ===
-os.environ["PINECONE_API_KEY"] = os.getenv("PINECONE_API_KEY") # Load from .env
+os.environ["PINECONE_API_KEY"] = PINECONE_API_KEY # Read by PineconeVectorStore
 pinecone_env = "us-east-1" # This can also be moved to .env if it changes per environment
 
-# === RAG Retriever Tool ===
-@tool("retriever_tool")
-def my_retriever_tool(question: str) -> str:
-    "acts as json reteriever"
-    pinecone_api_key = os.getenv("PINECONE_API_KEY") # Load from .env
+# === RAG Chain (built once, on first use) ===
+@lru_cache(maxsize=1)
+def _rag_chain():
     index_name = "git-test" # This can also be moved to .env if it changes per environment
 
-    pc = Pinecone(api_key=pinecone_api_key, environment=pinecone_env)
+    pc = Pinecone(api_key=PINECONE_API_KEY, environment=pinecone_env)
 
-    llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", api_key=os.getenv("GOOGLE_API_KEY_1")) # Load from .env
+    llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", api_key=GOOGLE_API_KEY_1)
     embeddings = GoogleGenerativeAIEmbeddings(
         model="models/embedding-001",
-        google_api_key=os.getenv("GOOGLE_API_KEY_1") # Load from .env
+        google_api_key=GOOGLE_API_KEY_1
     )
 
     vectorstore = PineconeVectorStore(index_name=index_name, embedding=embeddings)
@@ -79,115 +87,156 @@ def my_retriever_tool(question: str) -> str:
     ])
 
     Youtube_chain = create_stuff_documents_chain(llm, prompt)
-    rag_chain = create_retrieval_chain(retriever, Youtube_chain)
-    response = rag_chain.invoke({"input": question})
+    return create_retrieval_chain(retriever, Youtube_chain)
+
+@lru_cache(maxsize=256)
+def _retrieve_answer(question: str) -> str:
+    response = _rag_chain().invoke({"input": question})
     return response["answer"]
 
-tool_retriever = my_retriever_tool
+# === RAG Retriever Tool ===
+@tool("retriever_tool")
+def my_retriever_tool(question: str) -> str:
+    "acts as json reteriever"
+    return _retrieve_answer(question)
 
-llm = LLM(model='gemini/gemini-2.0-flash', api_key=os.getenv("GOOGLE_API_KEY_1"))
-llm_new = LLM(model='gemini/gemini-2.0-flash', api_key=os.getenv("GOOGLE_API_KEY_2"))
-
-# === Agent: Analyzer ===
-project_analyzer_agent = Agent(
-    role="Information Retrieval Expert",
-    goal="Retrieve and list all impacted classes and their paths based on the user's query.",
-    backstory=(
-        "You are an information retrieval expert in a Java Spring Boot project. "
-        "Given a user's query, you will retrieve relevant information about the impacted classes, "
-        "analyze it, and refine the query if necessary to ensure complete results. "
-        "Only list the class names and their paths without source code."
-    ),
-    tools=[tool_retriever],
-    llm=llm_new,
-    allow_delegation=False,
-    verbose=True
-)
-
-query_response_task = Task(
-    agent=project_analyzer_agent,
-    description=(
-        "Process the user's query: '{{user_query}}' by invoking the 'retriever_tool'. "
-        "After retrieving initial results, analyze for missing information. "
-        "Generate 1–2 refined queries if needed. "
-        "Use 'retriever_tool' again with those queries, combine the results, remove duplicates, "
-        "and return the final impacted classes and their file paths.\n\n"
-        "Format your final answer like this:\n\n"
-        "[\n"
-        "\"path/to/Class1.java\",\n"
-        "\"path/to/Class2.java\",\n"
-        "... \n]"
-    ),
-    expected_output="The final output must be a valid Python list assignment containing file paths.",
-    input={"user_query": "{{user_query}}"},
-    output_file="project_output/paths.txt"
-)
+tool_retriever = my_retriever_tool
 
 # === Agent: Multi-File Reader ===
+def _parse_file_paths(text: str):
+    """Returns the list of file paths in the previous task's answer, or None if it has none."""
+    match = re.search(r"\[.*\]", text or "", re.DOTALL)
+    if not match:
+        return None
+    try:
+        file_paths = ast.literal_eval(match.group(0))
+    except (ValueError, SyntaxError):
+        return None
+    if not isinstance(file_paths, list) or not all(isinstance(path, str) for path in file_paths):
+        return None
+    return file_paths
+
 class MultiFileReaderAgent(Agent):
-    def run(self, input_data):
-        file_paths = input_data.get("file_paths", [])
-        if isinstance(file_paths, str):
-            file_paths = ast.literal_eval(file_paths)
-
-        all_code = ""
-        for path in file_paths:
-            code = git_reader(path)
-            all_code += f"\n// FILE: {path}\n{code}\n"
-        return all_code
-
-file_reader_agent = MultiFileReaderAgent(
-    role="Java File Reader",
-    goal="Read Java files from GitHub and concatenate their content into a single output.",
-    backstory="You fetch multiple Java source codes from GitHub and combine them.",
-    tools=[git_reader],
-    llm=llm,
-    allow_delegation=False,
-    verbose=True
-)
-
-file_reading_task = Task(
-    agent=file_reader_agent,
-    description=(
-        "Given the Python list of file paths from the previous task, "
-        "read each file's content from GitHub and combine them."
-    ),
-    expected_output="Concatenated Java source code from all file paths.",
-    input={"file_paths": "{{query_response_task.output}}"},
-    output_file="project_output/code.txt"
-)
-
-# === Agent: Tech Lead ===
-tech_lead_agent = Agent(
-    role="Tech Lead",
-    goal="Generate comprehensive user stories for developers and testers based on code changes and user requirements.",
-    backstory="You are a highly experienced Tech Lead in a software company, skilled at translating feature requests into actionable user stories.",
-    tools=[git_reader],
-    llm=llm,
-    allow_delegation=False,
-    verbose=True
-)
-
-generate_stories_task = Task(
-    description=(
-        "Analyze the content of the provided combined Java code file ('code_file_path') and the user request: '{{user_query}}'. "
-        "Based on this analysis, generate two sets of user stories: one for developers and one for testers."
-    ),
-    agent=tech_lead_agent,
-    expected_output="A string containing Developer and Tester user stories, clearly labeled.",
-    input={
-        "code_file_path": "{{file_reading_task.output}}",
-        "user_query": "{{user_query}}"
-    },
-    output_file="project_output/stories.txt"
-)
-
-# === Crew Setup ===
-project_analysis_crew = Crew(
-    agents=[project_analyzer_agent, file_reader_agent, tech_lead_agent],
-    tasks=[query_response_task, file_reading_task, generate_stories_task],
-    process=Process.sequential
-)
+    def execute_task(self, task, context=None, tools=None) -> str:
+        # The previous task's answer is a plain list of paths, so read them directly
+        # instead of having the LLM call the tool once per file
+        file_paths = _parse_file_paths(context)
+        if file_paths is None:
+            return super().execute_task(task, context, tools)
+
+        if not file_paths:
+            return ""
+
+        # Each read is a blocking GitHub request, so fetch the files concurrently
+        with ThreadPoolExecutor(max_workers=min(16, len(file_paths))) as executor:
+            contents = executor.map(read_github_files.func, file_paths)
+
+            # Collect the pieces and join once, instead of growing one string per file
+            parts = []
+            append = parts.append
+            for path, code in zip(file_paths, contents):
+                append("\n// FILE: ")
+                append(path)
+                append("\n")
+                append(str(code))
+                append("\n")
+        return "".join(parts)
+
+# === Crew Setup (built on first use rather than at import time) ===
+@lru_cache(maxsize=1)
+def build_story_crew() -> Crew:
+    llm = CachedLLM(model='gemini/gemini-2.0-flash', api_key=GOOGLE_API_KEY_1)
+    llm_new = CachedLLM(model='gemini/gemini-2.0-flash', api_key=GOOGLE_API_KEY_2)
+
+    # === Agent: Analyzer ===
+    project_analyzer_agent = Agent(
+        role="Information Retrieval Expert",
+        goal="Retrieve and list all impacted classes and their paths based on the user's query.",
+        backstory=(
+            "You are an information retrieval expert in a Java Spring Boot project. "
+            "Given a user's query, you will retrieve relevant information about the impacted classes, "
+            "analyze it, and refine the query if necessary to ensure complete results. "
+            "Only list the class names and their paths without source code."
+        ),
+        tools=[tool_retriever],
+        llm=llm_new,
+        allow_delegation=False,
+        verbose=True
+    )
+
+    query_response_task = Task(
+        agent=project_analyzer_agent,
+        description=(
+            "Process the user's query: '{{user_query}}' by invoking the 'retriever_tool'. "
+            "After retrieving initial results, analyze for missing information. "
+            "Generate 1–2 refined queries if needed. "
+            "Use 'retriever_tool' again with those queries, combine the results, remove duplicates, "
+            "and return the final impacted classes and their file paths.\n\n"
+            "Format your final answer like this:\n\n"
+            "[\n"
+            "\"path/to/Class1.java\",\n"
+            "\"path/to/Class2.java\",\n"
+            "... \n]"
+        ),
+        expected_output="The final output must be a valid Python list assignment containing file paths.",
+        input={"user_query": "{{user_query}}"},
+        output_file="project_output/paths.txt"
+    )
+
+    # === Agent: Multi-File Reader ===
+    file_reader_agent = MultiFileReaderAgent(
+        role="Java File Reader",
+        goal="Read Java files from GitHub and concatenate their content into a single output.",
+        backstory="You fetch multiple Java source codes from GitHub and combine them.",
+        tools=[git_reader],
+        llm=llm,
+        allow_delegation=False,
+        verbose=True
+    )
+
+    file_reading_task = Task(
+        agent=file_reader_agent,
+        description=(
+            "Given the Python list of file paths from the previous task, "
+            "read each file's content from GitHub and combine them."
+        ),
+        expected_output="Concatenated Java source code from all file paths.",
+        input={"file_paths": "{{query_response_task.output}}"},
+        output_file="project_output/code.txt"
+    )
+
+    # === Agent: Tech Lead ===
+    tech_lead_agent = Agent(
+        role="Tech Lead",
+        goal="Generate comprehensive user stories for developers and testers based on code changes and user requirements.",
+        backstory="You are a highly experienced Tech Lead in a software company, skilled at translating feature requests into actionable user stories.",
+        tools=[git_reader],
+        llm=llm,
+        allow_delegation=False,
+        verbose=True
+    )
+
+    generate_stories_task = Task(
+        description=(
+            "Analyze the content of the provided combined Java code file ('code_file_path') and the user request: '{{user_query}}'. "
+            "Based on this analysis, generate two sets of user stories: one for developers and one for testers."
+        ),
+        agent=tech_lead_agent,
+        expected_output="A string containing Developer and Tester user stories, clearly labeled.",
+        input={
+            "code_file_path": "{{file_reading_task.output}}",
+            "user_query": "{{user_query}}"
+        },
+        output_file="project_output/stories.txt"
+    )
+
+    project_analysis_crew = Crew(
+        agents=[project_analyzer_agent, file_reader_agent, tech_lead_agent],
+        tasks=[query_response_task, file_reading_task, generate_stories_task],
+        process=Process.sequential
+    )
+
+    return project_analysis_crew
 
 # === Entry Function for Streamlit ===
 def run_story_generation(user_query: str, git_path: str, git_token: str) -> str:
@@ -195,7 +244,7 @@ def run_story_generation(user_query: str, git_path: str, git_token: str) -> str:
     repo_url = git_path
     token = git_token
 
-    result = project_analysis_crew.kickoff(inputs={
+    result = build_story_crew().kickoff(inputs={
         "user_query": user_query
     })
     return result
\ No newline at end of file